@@ -8,7 +8,9 @@ import random
 import subprocess
 import json
 import sys
+from operator import itemgetter
 from time import time, sleep
+from typing import Optional
 
 __version__ = "0.1.0"
 
@@ -17,7 +19,7 @@ RBD Snapshot Manager
 
 This script intends to fill the gap between a simple snapshot schedule and automated mirroring. It offers a simple
 housekeeping feature by keeping a configurable number of snapshots. Moreover, its concurrent-ready(TM) by exclusively 
-"locking" a pool/image combination (we take advantage of ceph's general purpose key/value store).
+"locking" a pool/image combination (we take advantage of RADOS advisory object locks).
 
 Usage example:
 
@@ -41,6 +43,17 @@ parser.add_argument('--image', required=True, help="RBD image name, find with `r
 parser.add_argument('--suffix', required=True, help="Snapshot suffix", type=str)
 parser.add_argument('--n_keep', required=True, help="How many snapshots with this suffix should we keep?",
                     type=int)
+parser.add_argument('--lock_retries', default=15, type=int,
+                    help="How many times to retry acquiring a contended lock before giving up. With the default "
+                         "backoff settings a run waits about 8 seconds in total (4-12 seconds with jitter), enough "
+                         "for a typical run holding the lock to finish. A run that gets the lock after waiting "
+                         "skips the rotation if another host already took a snapshot this tick")
+parser.add_argument('--lock_backoff_base', default=0.005, type=float,
+                    help="Initial delay in seconds between lock retries, doubled on each retry")
+parser.add_argument('--lock_backoff_cap', default=1.0, type=float,
+                    help="Maximum delay in seconds between lock retries")
+parser.add_argument('--lock_ttl', default=600, type=int,
+                    help="Seconds after which a lock left behind by a crashed run expires")
 parser.add_argument('--dryrun', action='store_true', default=False,
                     help="Do not change anything, implicitly enables debug mode")
 parser.add_argument('--debug', action='store_true', default=False, help="Be more verbose what we are doing")
@@ -52,6 +65,10 @@ POOL = args.pool  # type: str
 IMAGE = args.image  # type: str
 SUFFIX = args.suffix  # type: str
 N_KEEP = args.n_keep  # type: int
+LOCK_RETRIES = args.lock_retries  # type: int
+LOCK_BACKOFF_BASE = args.lock_backoff_base  # type: float
+LOCK_BACKOFF_CAP = args.lock_backoff_cap  # type: float
+LOCK_TTL = args.lock_ttl  # type: int
 DRYRUN = args.dryrun  # type: bool
 DEBUG = args.debug  # type: bool
 
@@ -62,146 +79,146 @@ else:
     logger.setLevel(logging.INFO)
     logger.addHandler(syslog_handler)
 
-_MONTHS = {
-    'Jan': 1,
-    'Feb': 2,
-    'Mar': 3,
-    'Apr': 4,
-    'May': 5,
-    'Jun': 6,
-    'Jul': 7,
-    'Aug': 8,
-    'Sep': 9,
-    'Oct': 10,
-    'Nov': 11,
-    'Dec': 12,
-}
-_RANDOM_SLEEP_RANGE = list(range(1, 20))
+_TIMESTAMP_FORMAT = "%a %b %d %H:%M:%S %Y"
+_STARTUP_JITTER = 1.0
+# runs of the same cron tick start within _STARTUP_JITTER of each other, the rest allows for clock skew between hosts
+_SAME_TICK_WINDOW = datetime.timedelta(seconds=30)
+_START_TIME = datetime.datetime.now()
 _SNAPSHOT_NAME = "{counter}_rbd_snap_manager_{suffix}"
-_LOCK_NAME = f"rbd_snap_mgr/lock_{POOL}/{IMAGE}"
-_LOCK_VALUE = f"{os.uname().nodename}@{time()}"
+_LOCK_OBJECT = f"rbd_snap_mgr.lock.{IMAGE}"
+_LOCK_NAME = "rbd_snap_mgr"
+_LOCK_COOKIE = f"{os.uname().nodename}@{time()}"
 
 COMMANDS = {
-    'list_pools': "ceph osd dump -f json",
-    'list_snapshots': "rbd snap ls {pool_name}/{image_name}",
-    'create_snapshot': "rbd snap create {pool_name}/{image_name}@{snap_name}",
-    'remove_snapshot': "rbd snap rm {pool_name}/{image_name}@{snap_name}",
-    'snapshot_rename': "rbd snap rename {pool_name}/{image_name}@{old_snap_name} {pool_name}/{image_name}@{new_snap_name}",
-    'lock_create': "ceph config-key set {lock_name} {lock_owner}",
-    'lock_exists': "ceph config-key exists {lock_name}",
-    'lock_remove': "ceph config-key rm {lock_name}",
-    'lock_get_value': "ceph config-key get {lock_name}"
+    'pool_application_get': ('ceph', 'osd', 'pool', 'application', 'get', '{pool_name}', 'rbd'),
+    'list_snapshots': ('rbd', 'snap', 'ls', '{pool_name}/{image_name}', '--format', 'json'),
+    'create_snapshot': ('rbd', 'snap', 'create', '{pool_name}/{image_name}@{snap_name}'),
+    'remove_snapshot': ('rbd', 'snap', 'rm', '{pool_name}/{image_name}@{snap_name}'),
+    'snapshot_rename': ('rbd', 'snap', 'rename', '{pool_name}/{image_name}@{old_snap_name}',
+                        '{pool_name}/{image_name}@{new_snap_name}'),
+    'lock_create': ('rados', '--pool', '{pool_name}', 'lock', 'get', '{lock_object}', '{lock_name}',
+                    '--lock-type', 'exclusive', '--lock-cookie', '{lock_cookie}', '--lock-duration', '{lock_ttl}'),
+    'lock_info': ('rados', '--pool', '{pool_name}', 'lock', 'info', '{lock_object}', '{lock_name}',
+                  '--format', 'json'),
+    'lock_remove': ('rados', '--pool', '{pool_name}', 'lock', 'break', '{lock_object}', '{lock_name}', '{locker}',
+                    '--lock-cookie', '{lock_cookie}')
 }
 
 
-def _parse_rbd_enabled_pools(raw_output: str) -> dict:
-    results = {}
-    raw_json = json.loads(raw_output)
-    for pool in raw_json['pools']:
-        if 'rbd' in pool['application_metadata']:
-            results[pool['pool_name']] = pool['pool']
-    return results
+def _format_command(name: str, **kwargs) -> list:
+    """
+    Fills the placeholders of a COMMANDS template token by token
+    :param name: Key in COMMANDS
+    :param kwargs: Values for the placeholders
+    :return: argv list, ready for run_command()
+    """
+    return [token.format(**kwargs) for token in COMMANDS[name]]
 
 
-def _snapshot_ls_parser(raw_output: str) -> list:
+def _snapshot_ls_parser(raw_output: str, suffix: str) -> list:
     results = []
-    for line in raw_output.splitlines():
-        if line.startswith('SNAPID'):
+    for entry in json.loads(raw_output):
+        name = entry['name']
+        if not name.endswith(suffix):
+            continue
+        try:
+            counter = int(name.split('_', 1)[0])
+        except ValueError:
+            # not one of ours
             continue
-        tokenized_line = line.split()
-        if len(tokenized_line) > 0:
-            if len(tokenized_line) > 9:
-                snap_id, name, size, unit, protected, _, month, day, time, year = tokenized_line
-            else:
-                protected = 'no'
-                snap_id, name, size, unit, _, month, day, time, year = tokenized_line
-
-            hour, minute, second = time.split(':')
-            results.append({
-                'snap_id': snap_id,
-                'name': name,
-                'protected': True if protected == 'yes' else False,
-                'created': datetime.datetime(month=_MONTHS[month],
-                                             day=int(day),
-                                             year=int(year),
-                                             hour=int(hour),
-                                             minute=int(minute),
-                                             second=int(second))
-            })
+        results.append({
+            'snap_id': entry['id'],
+            'name': name,
+            'counter': counter,
+            'protected': entry.get('protected') == 'true',
+            'created': datetime.datetime.strptime(entry['timestamp'], _TIMESTAMP_FORMAT)
+        })
     return results
 
 
-def run_command(cmd: str, die_on_error=True):
+def run_command(cmd: list, die_on_error=True):
     """
     Uses python's subprocess module to run an arbitrary command
-    :param cmd: Command line
+    :param cmd: argv list, see _format_command()
     :param die_on_error: Should we die on error or is the error handled by the caller?
     :return: n-tuple of reference to stdout, stderr and return code
     """
-    result = subprocess.run(cmd.split(), capture_output=True)
+    # fds opened by python are non-inheritable anyway, skip closing all of them in the child
+    result = subprocess.run(cmd, capture_output=True, close_fds=False)
     if result.returncode != 0 and die_on_error:
-        die_error(f"Command `{cmd}` failed error: {result.stderr.decode()}")
+        die_error(f"Command `{' '.join(cmd)}` failed error: {result.stderr.decode()}")
     return result.stdout, result.stderr, result.returncode
 
 
+def validate_pool():
+    """
+    Makes sure POOL exists and has the rbd application enabled. Must run before acquire_lock(), which creates
+    the lock object in POOL.
+    """
+    pool_application_cmd = _format_command('pool_application_get', pool_name=POOL)
+    _, stderr, ret = run_command(pool_application_cmd, die_on_error=False)
+    if ret != 0:
+        die_error(f"Pool `{POOL}` not found in cluster or not rbd enabled, error: {stderr.decode()}")
+
+
 def list_snapshots() -> list:
     """
-    Validates the pool name and lists snapshots matching SUFFIX. Calls snapshot_ls_parser()
+    Lists snapshots matching SUFFIX. Calls snapshot_ls_parser()
     :return: A list of dicts, sorted by snapshot number in decreasing order
     """
-    get_pools_cmd = COMMANDS['list_pools']
-
-    stdout, _, _ = run_command(get_pools_cmd)
-    rbd_pools = _parse_rbd_enabled_pools(stdout.decode())
-
-    # validate pool name
-    if POOL in rbd_pools:
-        list_snapshots_cmd = COMMANDS['list_snapshots'].format(pool_name=POOL, image_name=IMAGE)
-        stdout, _, _ = run_command(list_snapshots_cmd)
-        snapshots = _snapshot_ls_parser(stdout.decode())
-        interesting_snapshots = sorted(list(filter(lambda snap: snap['name'].endswith(SUFFIX), snapshots)),
-                                       key=lambda snap: int(snap.get('name').split('_')[0]), reverse=True)
-        if len(interesting_snapshots) > 0:
-            return interesting_snapshots
-        else:
-            logger.debug(f"Found no snapshots matching {SUFFIX}")
-            return []
+    list_snapshots_cmd = _format_command('list_snapshots', pool_name=POOL, image_name=IMAGE)
+    stdout, _, _ = run_command(list_snapshots_cmd)
+    interesting_snapshots = sorted(_snapshot_ls_parser(stdout.decode(), SUFFIX),
+                                   key=itemgetter('counter'), reverse=True)
+    if len(interesting_snapshots) > 0:
+        return interesting_snapshots
     else:
-        die_error(f"Pool `{POOL}` not found in cluster")
+        logger.debug(f"Found no snapshots matching {SUFFIX}")
+        return []
 
 
 def _get_snapshot_name() -> str:
     return _SNAPSHOT_NAME.format(counter=0, suffix=SUFFIX)
 
 
-def acquire_lock():
+def acquire_lock() -> bool:
     """
-    Uses ceph's general key/value store to "lock" the snapshotting process.
+    Takes an exclusive RADOS advisory lock on _LOCK_OBJECT to "lock" the snapshotting process. Taking the lock
+    is a single atomic operation, so there is no window between checking and setting it. The lock expires after
+    LOCK_TTL seconds, so a crashed run does not block all following runs. If the lock is held, retries
+    LOCK_RETRIES times with a jittered, truncated exponential backoff before giving up.
+    :return: True if we had to wait for another run to release the lock
     """
-    check_lock_cmd = COMMANDS['lock_exists'].format(lock_name=_LOCK_NAME)
-    logger.debug(f"Check if `{_LOCK_NAME}`exists...")
-    stdout, stderr, ret = run_command(check_lock_cmd, False)
-    if ret != 0 and "doesn't" in stderr.decode():
-        logger.debug(f"Lock `{_LOCK_NAME}` did not exist, creating...")
-        create_lock_cmd = COMMANDS['lock_create'].format(lock_name=_LOCK_NAME, lock_owner=_LOCK_VALUE)
-        run_command(create_lock_cmd)
-        # check if we actually acquired the lock
-        if not is_our_lock():
-            die_error(f"Lock `{_LOCK_NAME}` Is not owned by us, exiting...")
-    else:
-        die_ok(f"Lock `{_LOCK_NAME}` present, exiting...")
+    create_lock_cmd = _format_command('lock_create', pool_name=POOL, lock_object=_LOCK_OBJECT,
+                                      lock_name=_LOCK_NAME, lock_cookie=_LOCK_COOKIE, lock_ttl=LOCK_TTL)
+    for attempt in range(LOCK_RETRIES + 1):
+        logger.debug(f"Trying to lock `{_LOCK_OBJECT}`...")
+        _, stderr, ret = run_command(create_lock_cmd, die_on_error=False)
+        if ret == 0:
+            logger.debug(f"Lock `{_LOCK_OBJECT}` acquired")
+            return attempt > 0
+        # rados exits with 1 on every error, only the EBUSY message tells contention apart from other failures
+        if "busy" not in stderr.decode().lower():
+            die_error(f"Could not lock `{_LOCK_OBJECT}`, error: {stderr.decode()}")
+        if attempt < LOCK_RETRIES:
+            delay = min(LOCK_BACKOFF_CAP, LOCK_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.debug(f"Lock `{_LOCK_OBJECT}` present, retrying in {delay:.3f} seconds")
+            sleep(delay)
+    die_ok(f"Lock `{_LOCK_OBJECT}` present, exiting...")
 
 
 def release_lock():
     """
     Removes an acquired lock (if it was created by us)
     """
-    if is_our_lock():
-        remove_lock_cmd = COMMANDS['lock_remove'].format(lock_name=_LOCK_NAME)
+    locker = get_our_locker()
+    if locker is not None:
+        remove_lock_cmd = _format_command('lock_remove', pool_name=POOL, lock_object=_LOCK_OBJECT,
+                                          lock_name=_LOCK_NAME, locker=locker, lock_cookie=_LOCK_COOKIE)
         run_command(remove_lock_cmd)
-        logger.debug(f"Lock `{_LOCK_NAME}` removed")
+        logger.debug(f"Lock `{_LOCK_OBJECT}` removed")
     else:
-        die_error(f"Lock `{_LOCK_NAME}` was not created by us. Not removed")
+        die_error(f"Lock `{_LOCK_OBJECT}` was not created by us. Not removed")
 
 
 def die_ok(msg: str):
@@ -214,15 +231,33 @@ def die_error(msg: str):
     exit(-1)
 
 
-def is_our_lock() -> bool:
+def get_our_locker() -> Optional[str]:
     """
-    Checks if the lock is actually ours by comparing _LOCK_NAME with the value stored in _LOCK_NAME
-    :return: True if they match and return code is 0
+    Looks up the holder of _LOCK_NAME on _LOCK_OBJECT. RADOS identifies lockers by their client session,
+    which differs for every rados invocation, so the lock is matched by _LOCK_COOKIE instead.
+    :return: Locker name (e.g. client.4123) if the lock is held with our cookie, None otherwise
     """
-    get_lock_value_cmd = COMMANDS['lock_get_value'].format(lock_name=_LOCK_NAME)
-    stdout, _, ret = run_command(get_lock_value_cmd, die_on_error=False)
-    lock_owner = stdout.decode().strip()
-    return lock_owner == _LOCK_VALUE and ret == 0
+    lock_info_cmd = _format_command('lock_info', pool_name=POOL, lock_object=_LOCK_OBJECT, lock_name=_LOCK_NAME)
+    stdout, _, ret = run_command(lock_info_cmd, die_on_error=False)
+    if ret != 0:
+        return None
+    for locker in json.loads(stdout.decode()).get('lockers', []):
+        if locker.get('cookie') == _LOCK_COOKIE:
+            return locker['name']
+    return None
+
+
+def snapshot_taken_this_tick(snapshot_list: list) -> bool:
+    """
+    Checks if the newest snapshot was created by another host during the current cron tick. Used after waiting
+    for the lock, so only one host rotates the snapshots per tick.
+    :param snapshot_list: list of snapshots (obtained through list_snapshots() )
+    :return: True if the newest snapshot was created less than _SAME_TICK_WINDOW before we started
+    """
+    if len(snapshot_list) == 0:
+        return False
+    # snapshot_list is sorted in decreasing order, the newest snapshot is the last one
+    return snapshot_list[-1]['created'] >= _START_TIME - _SAME_TICK_WINDOW
 
 
 def rename_snapshots(snapshot_list: list):
@@ -232,16 +267,12 @@ def rename_snapshots(snapshot_list: list):
     """
     for snapshot in snapshot_list:
         s_name = snapshot['name']
-        try:
-            s_number = int(s_name.split('_')[0])
-            new_name = _SNAPSHOT_NAME.format(counter=s_number + 1, suffix=SUFFIX)
-            snapshot_rename_cmd = COMMANDS['snapshot_rename'].format(pool_name=POOL, image_name=IMAGE,
-                                                                     old_snap_name=s_name, new_snap_name=new_name)
-            logger.debug(f"Renaming snapshot {s_name} -> {new_name}")
-            if not DRYRUN:
-                run_command(snapshot_rename_cmd)
-        except ValueError as ve:
-            die_error(f"Could not parse snapshot name {s_name}, error: {ve}")
+        new_name = _SNAPSHOT_NAME.format(counter=snapshot['counter'] + 1, suffix=SUFFIX)
+        snapshot_rename_cmd = _format_command('snapshot_rename', pool_name=POOL, image_name=IMAGE,
+                                              old_snap_name=s_name, new_snap_name=new_name)
+        logger.debug(f"Renaming snapshot {s_name} -> {new_name}")
+        if not DRYRUN:
+            run_command(snapshot_rename_cmd)
 
 
 def create_snapshot():
@@ -249,44 +280,56 @@ def create_snapshot():
     Creates a new snapshot with number 0
     :return:
     """
-    snapshot_name = _SNAPSHOT_NAME.format(counter=0, suffix=SUFFIX)
-    create_snapshot_cmd = COMMANDS['create_snapshot'].format(pool_name=POOL, image_name=IMAGE,
-                                                             snap_name=snapshot_name)
+    snapshot_name = _get_snapshot_name()
+    create_snapshot_cmd = _format_command('create_snapshot', pool_name=POOL, image_name=IMAGE,
+                                          snap_name=snapshot_name)
     if not DRYRUN:
         run_command(create_snapshot_cmd)
     logger.debug(f"Snapshot `{snapshot_name}` created ")
 
 
-def cleanup():
+def cleanup(snapshot_list: list):
     """
     Removes the snapshot with the highest number if the SUFFIX matches and the number snapshots
-    with SUFFIX is > N_KEEP
+    with SUFFIX is > N_KEEP. Works on the list obtained before rename_snapshots() and create_snapshot(),
+    so the cluster does not have to be queried again.
+    :param snapshot_list: list of snapshots (obtained through list_snapshots() )
     """
-    updated_snapshot_list = list_snapshots()
-    if len(updated_snapshot_list) < N_KEEP:
+    # the freshly created snapshot is not part of snapshot_list
+    if len(snapshot_list) + 1 < N_KEEP:
         die_ok(f"No snapshots to remove since we have less than {N_KEEP}")
+    elif len(snapshot_list) > 0:
+        # snapshot_list is sorted in decreasing order and has been renamed by one since
+        snapshot_to_remove = _SNAPSHOT_NAME.format(counter=snapshot_list[0]['counter'] + 1, suffix=SUFFIX)
     else:
-        snapshot_to_remove = updated_snapshot_list[0]['name']
-        if not DRYRUN:
-            snapshot_rm_cmd = COMMANDS['remove_snapshot'].format(pool_name=POOL, image_name=IMAGE,
-                                                                 snap_name=snapshot_to_remove)
-            run_command(snapshot_rm_cmd)
-        logger.debug(f"Snapshot `{snapshot_to_remove}` removed ")
+        # only possible with N_KEEP <= 1, the freshly created snapshot is the highest one
+        snapshot_to_remove = _get_snapshot_name()
+    if not DRYRUN:
+        snapshot_rm_cmd = _format_command('remove_snapshot', pool_name=POOL, image_name=IMAGE,
+                                          snap_name=snapshot_to_remove)
+        run_command(snapshot_rm_cmd)
+    logger.debug(f"Snapshot `{snapshot_to_remove}` removed ")
 
 
 if __name__ == '__main__':
     if DRYRUN:
         logger.debug("##### Running in dryrun mode!! #####")
     try:
-        sleep_duration = random.choice(_RANDOM_SLEEP_RANGE)
-        logger.debug(f"Sleeping for {sleep_duration} seconds")
+        sleep_duration = random.uniform(0, _STARTUP_JITTER)
+        logger.debug(f"Sleeping for {sleep_duration:.3f} seconds")
         sleep(sleep_duration)
-        snapshot_list = list_snapshots()
-        acquire_lock()
-        rename_snapshots(snapshot_list)
-        create_snapshot()
-        cleanup()
+        validate_pool()
+        waited_for_lock = acquire_lock()
+        # only release what we actually acquired, acquire_lock() exits if it did not get the lock
+        try:
+            # list under the lock, a run we waited for has renamed and created snapshots in the meantime
+            snapshot_list = list_snapshots()
+            if waited_for_lock and snapshot_taken_this_tick(snapshot_list):
+                die_ok("Snapshot of this tick already taken by another host, exiting...")
+            rename_snapshots(snapshot_list)
+            create_snapshot()
+            cleanup(snapshot_list)
+        finally:
+            release_lock()
     except Exception as e:
         logger.error(f"An unrecoverable error happened: \n {e}")
-    finally:
-        release_lock()